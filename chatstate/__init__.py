@@ -1,3 +1,4 @@
+import sys
 from collections import namedtuple
 
 EMPTY_DICT    = dict()
@@ -9,4 +10,6 @@ ChatType = namedtuple('ChatType', ('PRIVATE', 'GROUP', 'CHANNEL', 'SUPERGROUP',
 CHAT_TYPE = ChatType(PRIVATE, GROUP, CHANNEL, SUPERGROUP, ANY, NONE)
 
 ChatTypeName = namedtuple('ChatTypeName', ('private', 'group', 'channel', 'supergroup'))
-CHAT_TYPE_NAME = ChatTypeName(PRIVATE, GROUP, CHANNEL, SUPERGROUP)
\ No newline at end of file
+CHAT_TYPE_NAME = ChatTypeName(PRIVATE, GROUP, CHANNEL, SUPERGROUP)
+CHAT_TYPE_BY_NAME = {sys.intern(name): value
+                     for name, value in zip(CHAT_TYPE_NAME._fields, CHAT_TYPE_NAME)}
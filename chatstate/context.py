@@ -1,204 +1,270 @@
+import asyncio
+import functools
+import heapq
 import logging
-from datetime import datetime
+import re
+import threading
+import time
 
-from chatstate import decorators, CHAT_TYPE
+from chatstate import decorators, CHAT_TYPE, EMPTY_DICT, EMPTY_TUPLE
+from chatstate.locking import HAS_UWSGI, LOCK
 
 
 LOG = logging.getLogger(__name__)
 
+_CHAT_TYPES = frozenset(CHAT_TYPE)
+
+NS_PER_SECOND = 1000000000
+
+CREATE_LOCK_STRIPES = 16
+
+_COMMAND_RE = re.compile(r'(/\w+)(?:@(\w+))?\Z')
+
+
+def _sender(name, bot_method, arg_names, **defaults):
+    """
+        Build a send_* method that forwards its positional arguments, by
+        name, and its keyword arguments to bot_method for this chat.
+    """
+    def send(self, *args, **kwargs):
+        if len(args) > len(arg_names):
+            raise TypeError('%s() takes %d positional arguments but %d were given'
+                            % (name, len(arg_names), len(args)))
+        for arg_name, value in zip(arg_names, args):
+            if arg_name in kwargs:
+                raise TypeError('%s() got multiple values for argument %r'
+                                % (name, arg_name))
+            kwargs[arg_name] = value
+        for arg_name in arg_names:
+            if arg_name not in kwargs:
+                raise TypeError('%s() missing argument: %s' % (name, arg_name))
+        for key, value in defaults.items():
+            kwargs.setdefault(key, value)
+        return getattr(self.bot, bot_method)(self.chat_id, **kwargs)
+    send.__name__ = send.__qualname__ = name
+    return send
+
+def _async_sender(name, send_name):
+    """
+        Build an a_send_* coroutine that runs the blocking send_name
+        method in a worker thread and awaits its result.
+    """
+    async def send(self, *args, **kwargs):
+        call = functools.partial(getattr(self, send_name), *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(None, call)
+    send.__name__ = send.__qualname__ = name
+    return send
+
+def _unsupported(name):
+    """Build a send_* method for a chat that does not support it"""
+    def send(self, *args, **kwargs):
+        raise NotImplementedError('%s is not supported by %s'
+                                  % (name, type(self).__name__))
+    send.__name__ = send.__qualname__ = name
+    return send
+
 
 class BaseChatContext(object):
 
+    __slots__ = ('chat_id', 'chat_type', 'last_active', 'me', 'bot',
+                 'dispatcher', '_instance', '_h', '_command_names')
+
+    _TRANSIENT = frozenset(('me', 'bot', 'last_active', 'dispatcher'))
+
+    _ATTACHMENTS = ('document', 'photo', 'video')
+
     def __init__(self, dispatcher, chat_id, chat_type):
         self.chat_id = chat_id
         self.chat_type = chat_type
         self.activate(dispatcher)
 
     def activate(self, dispatcher):
-        self.last_active = datetime.now()
+        self.last_active = time.monotonic_ns()
         self.me = dispatcher.me
         self.bot = dispatcher.bot
         self.dispatcher = dispatcher
 
+    @classmethod
+    def _slot_names(cls):
+        """Return the slots declared along cls' MRO, cached on cls"""
+        result = cls.__dict__.get('_SLOT_NAMES')
+        if result is None:
+            result = frozenset(slot for class_ in cls.__mro__
+                               for slot in getattr(class_, '__slots__', ()))
+            setattr(cls, '_SLOT_NAMES', result)
+        return result
+
     def __getstate__(self):
-        result = dict(self.__dict__)
-        del result['me']
-        del result['bot']
-        del result['last_active']
-        del result['dispatcher']
+        result = dict()
+        for slot in self._slot_names():
+            if slot not in self._TRANSIENT and hasattr(self, slot):
+                result[slot] = getattr(self, slot)
         return result
 
     def __setstate__(self, data):
-        self.__dict__ = data
+        """
+            Restore the slots found in data. States pickled before the
+            slotted layout carry per-handler attributes instead of _h, those
+            are skipped and the handler table is rebuilt from _instance.
+        """
+        slots = self._slot_names()
+        for key, value in data.items():
+            if key in slots:
+                setattr(self, key, value)
+        if not hasattr(self, '_h') and hasattr(self, '_instance'):
+            self.register_handler(self._instance)
 
     def register_handler(self, instance):
         self._instance = instance
-        method_handlers = decorators.extract_handlers(self.chat_type, instance)
-        self._message_handler = method_handlers[0]
-        self._command_handlers = method_handlers[1]
-        self._document_handler = method_handlers[2]
-        self._photo_handler = method_handlers[3]
-        self._video_handler = method_handlers[4]
-        self._callbackquery_handler = method_handlers[5]
-        self._event_handlers = method_handlers[6]
-        self._activate_handler = method_handlers[7]
-        self._newchatmember_handler = method_handlers[8]
-        self._leftchatmember_handler = method_handlers[9]
-        self._idle_handler = method_handlers[10]
-        self._stop_handler = method_handlers[11]
+        self._h = decorators.extract_handlers(self.chat_type, instance)
+        self._command_names = tuple(self._h.command)
 
     def handle_message(self, update):
-            self.last_active = datetime.now()
-            handlers = []
-            if update.message.entities:
-                handlers.extend(self._process_entities(update))
-
-            joined_members = update.message.new_chat_members
-            if joined_members:
-                for member in joined_members:
-                    LOG.debug('User joined, %d %s', member.id, member.username)
-                    if self._newchatmember_handler:
-                        handlers.append(self._newchatmember_handler)
-
-            left_member = update.message.left_chat_member
-            if left_member:
-                LOG.debug('User left, %d %s',
-                                left_member.id, left_member.username)
-                if left_member.id == self.bot.id:
-                    LOG.debug('removing myself from dispatcher')
-                    self.dispatcher.remove_chat_context(self)
-                elif self._leftchatmember_handler:
-                    handlers.append(self._leftchatmember_handler)
-
-            document = update.message.document
-            if document and self._document_handler:
-                handlers.append(self._document_handler)
-
-            photo = update.message.photo
-            if photo and self._photo_handler:
-                handlers.append(self._photo_handler)
-
-            video = update.message.video
-            if video and self._video_handler:
-                handlers.append(self._video_handler)
-
-            handlers.append(self._message_handler)
+        self.last_active = time.monotonic_ns()
+        message = update.message
+        if not (message.entities or message.new_chat_members
+                or message.left_chat_member or message.document
+                or message.photo or message.video):
+            self._h.message and self._h.message(update)
+            return
+
+        handlers = []
+        if message.entities:
+            handlers.extend(self._process_entities(update))
+
+        joined_members = message.new_chat_members
+        if joined_members:
+            for member in joined_members:
+                LOG.debug('User joined, %d %s', member.id, member.username)
+                if self._h.new_chat_member:
+                    handlers.append(self._h.new_chat_member)
+
+        left_member = message.left_chat_member
+        if left_member:
+            LOG.debug('User left, %d %s',
+                            left_member.id, left_member.username)
+            if left_member.id == self.me.id:
+                LOG.debug('removing myself from dispatcher')
+                self.dispatcher.remove_chat_context(self)
+            elif self._h.left_chat_member:
+                handlers.append(self._h.left_chat_member)
+
+        for attachment in self._ATTACHMENTS:
+            handler = getattr(self._h, attachment)
+            if handler and getattr(message, attachment):
+                handlers.append(handler)
+
+        if self._h.message:
+            handlers.append(self._h.message)
+        if LOG.isEnabledFor(logging.DEBUG):
             LOG.debug('handlers for update: %s', handlers)
-            for handler in handlers:
-                handler(update)
+        for handler in handlers:
+            handler(update)
 
     def _process_entities(self, update):
-        result = []
-        for ent in [e for e in update.message.entities]:
-            LOG.debug('search entity for %s in %s',
-                            ent, tuple(self._command_handlers.keys()))
-            entity = update.message.text[ent.offset: ent.offset + ent.length]
-            if ent.type == 'bot_command':
-                for_me, recipient = False, None
-                tokens = self._split_recipient(entity)
-                if tokens: command, recipient = tokens
-                else: command = entity
-
-                if self.chat_type == CHAT_TYPE.PRIVATE:
-                    for_me = True
-                elif tokens:
-                    for_me = recipient == self.me.username
-
-                if for_me:
+        result, message = [], update.message
+        text, debug = message.text, LOG.isEnabledFor(logging.DEBUG)
+        commands, private = self._h.command, self.chat_type == CHAT_TYPE.PRIVATE
+        username = self.me.username
+        for ent in message.entities:
+            if ent.type != 'bot_command':
+                continue
+            if debug:
+                LOG.debug('search entity for %s in %s', ent, self._command_names)
+            start, end = ent.offset, ent.offset + ent.length
+            match = _COMMAND_RE.match(text, start, end)
+            if match:
+                command, recipient = match.group(1, 2)
+            else:
+                command, recipient = text[start:end], None
+
+            for_me = private or (recipient is not None and recipient == username)
+
+            if for_me:
+                if debug:
                     LOG.debug('command to handle %s', command)
-                    if command == '/stop':
-                        LOG.debug('remove chat %s', self.chat_id)
-                        self.dispatcher.remove_chat_context(self)
-                    if command in self._command_handlers:
-                        result.append(self._command_handlers[command])
-        return result
-
-    @staticmethod
-    def _split_recipient(text):
-        result = None
-        chunks = text.rsplit('@', 1)
-        if len(chunks) == 2: result = chunks
+                if command == '/stop':
+                    LOG.debug('remove chat %s', self.chat_id)
+                    self.dispatcher.remove_chat_context(self)
+                handler = commands.get(command)
+                if handler is not None:
+                    result.append(handler)
         return result
 
     def handle_callback_query(self, update):
-        self.last_active = datetime.now()
-        self._callbackquery_handler and self._callbackquery_handler(update)
+        self.last_active = time.monotonic_ns()
+        handler = self._h.callback_query
+        if handler is None:
+            return
+        handler(update)
 
     def handle_inline_callback_query(self, update):
-        self.last_active = datetime.now()
+        self.last_active = time.monotonic_ns()
 
     def on_activate(self):
-        self.last_active = datetime.now()
-        self._activate_handler and self._activate_handler(self)
+        self.last_active = time.monotonic_ns()
+        self._h.activate and self._h.activate(self)
 
     def on_idle(self):
         result = True
-        if self._idle_handler: result = self._idle_handler()
+        if self._h.idle: result = self._h.idle()
         return result
 
     def on_stop(self):
         result = True
-        if self._stop_handler: result = self._stop_handler()
+        if self._h.stop: result = self._h.stop()
         return result
 
-    def on_event(self, evt, data):
-        if evt in self._event_handlers:
-            self.last_active = datetime.now()
-            for handler in self._event_handlers[evt]: handler(data)
-
-    def broadcast_event(self, event, data=dict()):
-        self.dispatcher.broadcast_event(event, data)
-
-    def send_message(self, text, **kwargs):
-        kwargs.setdefault('text', text)
-        kwargs.setdefault('parse_mode', 'Markdown')
-        return self.bot.sendMessage(self.chat_id, **kwargs)
-
-    def send_audio(self, audio, **kwargs):
-        kwargs.setdefault('audio', audio)
-        return self.bot.sendAudio(self.chat_id, **kwargs)
-
-    def send_document(self, document, **kwargs):
-        kwargs.setdefault('document', document)
-        return self.bot.sendDocument(self.chat_id, **kwargs)
-
-    def send_voice(self, voice, **kwargs):
-        kwargs.setdefault('voice', voice)
-        return self.bot.sendVoice(self.chat_id, **kwargs)
-
-    def send_location(self, latitude, longitude, **kwargs):
-        kwargs.setdefault('latitude', latitude)
-        kwargs.setdefault('longitude', longitude)
-        return self.bot.sendLocation(self.chat_id, **kwargs)
-
-    def send_venue(self, latitude, longitude, title, address, **kwargs):
-        kwargs.setdefault('latitude', latitude)
-        kwargs.setdefault('longitude', longitude)
-        kwargs.setdefault('title', title)
-        kwargs.setdefault('address', address)
-        return self.bot.sendLocation(self.chat_id, **kwargs)
-
-    def send_chat_action(self, action, **kwargs):
-        kwargs.setdefault('action', action)
-        return self.bot.sendChatAction(self.chat_id, **kwargs)
+    def handles_callback_query(self):
+        return self._h.callback_query is not None
 
-    def send_contact(self, first_name, last_name, phone_number, **kwargs):
-        kwargs.setdefault('first_name', first_name)
-        kwargs.setdefault('last_name', last_name)
-        kwargs.setdefault('phone_number', phone_number)
-        return self.bot.sendContact(self.chat_id, **kwargs)
+    def handles_stop(self):
+        return self._h.stop is not None
 
-    def send_photo(self, photo, **kwargs):
-        kwargs.setdefault('photo', photo)
-        return self.bot.sendPhoto(self.chat_id, **kwargs)
+    def handles_event(self, evt):
+        return evt in self._h.event
 
-    def send_video(self, video, **kwargs):
-        kwargs.setdefault('video', video)
-        return self.bot.sendVideo(self.chat_id, **kwargs)
+    def on_event(self, evt, data):
+        handlers = self._h.event.get(evt)
+        if not handlers:
+            return
+        self.last_active = time.monotonic_ns()
+        for handler in handlers: handler(data)
+
+    def broadcast_event(self, event, data=None):
+        self.dispatcher.broadcast_event(event, {} if data is None else data)
+
+    send_message = _sender('send_message', 'sendMessage', ('text',),
+                           parse_mode='Markdown')
+    send_audio = _sender('send_audio', 'sendAudio', ('audio',))
+    send_document = _sender('send_document', 'sendDocument', ('document',))
+    send_voice = _sender('send_voice', 'sendVoice', ('voice',))
+    send_location = _sender('send_location', 'sendLocation',
+                            ('latitude', 'longitude'))
+    send_venue = _sender('send_venue', 'sendVenue',
+                         ('latitude', 'longitude', 'title', 'address'))
+    send_chat_action = _sender('send_chat_action', 'sendChatAction', ('action',))
+    send_contact = _sender('send_contact', 'sendContact',
+                           ('first_name', 'last_name', 'phone_number'))
+    send_photo = _sender('send_photo', 'sendPhoto', ('photo',))
+    send_video = _sender('send_video', 'sendVideo', ('video',))
+
+    a_send_message = _async_sender('a_send_message', 'send_message')
+    a_send_audio = _async_sender('a_send_audio', 'send_audio')
+    a_send_document = _async_sender('a_send_document', 'send_document')
+    a_send_voice = _async_sender('a_send_voice', 'send_voice')
+    a_send_location = _async_sender('a_send_location', 'send_location')
+    a_send_venue = _async_sender('a_send_venue', 'send_venue')
+    a_send_chat_action = _async_sender('a_send_chat_action', 'send_chat_action')
+    a_send_contact = _async_sender('a_send_contact', 'send_contact')
+    a_send_photo = _async_sender('a_send_photo', 'send_photo')
+    a_send_video = _async_sender('a_send_video', 'send_video')
 
 
 class PrivateChatContext(BaseChatContext):
 
+    __slots__ = ('first_name', 'last_name', 'username')
+
     def __init__(self, dispatcher, chat_id, first_name, last_name=None, username=None):
         super().__init__(dispatcher, chat_id, CHAT_TYPE.PRIVATE)
         self.first_name = first_name
@@ -208,47 +274,34 @@ class PrivateChatContext(BaseChatContext):
 
 class GroupChatContext(BaseChatContext):
 
+    __slots__ = ('group_name',)
+
     def __init__(self, dispatcher, chat_id, group_name):
         super().__init__(dispatcher, chat_id, CHAT_TYPE.GROUP)
         self.group_name = group_name
 
 
 class SupergroupChatContext(GroupChatContext):
-    pass
+    __slots__ = ()
 
 
 class ChannelChatContext(BaseChatContext):
 
+    __slots__ = ('channel_name',)
+
     def __init__(self, dispatcher, chat_id: int, channel_name: str) -> None:
         super().__init__(dispatcher, chat_id, CHAT_TYPE.CHANNEL)
         self.channel_name = channel_name
 
-    def send_message(self, text, **kwargs):
-        raise NotImplemented
-
-    def send_audio(self, audio, **kwargs):
-        raise NotImplemented
-
-    def send_voice(self, voice, **kwargs):
-        raise NotImplemented
-
-    def send_location(self, latitude, longitude, **kwargs):
-        raise NotImplemented
-
-    def send_venue(self, latitude, longitude, title, address, **kwargs):
-        raise NotImplemented
-
-    def send_chat_action(self, action, **kwargs):
-        raise NotImplemented
-
-    def send_contact(self, first_name, last_name, phone_number, **kwargs):
-        raise NotImplemented
-
-    def send_photo(self, photo, **kwargs):
-        raise NotImplemented
-
-    def send_video(self, video, **kwargs):
-        raise NotImplemented
+    send_message = _unsupported('send_message')
+    send_audio = _unsupported('send_audio')
+    send_voice = _unsupported('send_voice')
+    send_location = _unsupported('send_location')
+    send_venue = _unsupported('send_venue')
+    send_chat_action = _unsupported('send_chat_action')
+    send_contact = _unsupported('send_contact')
+    send_photo = _unsupported('send_photo')
+    send_video = _unsupported('send_video')
 
 
 class ChatContextClassRegistry(object):
@@ -256,17 +309,39 @@ class ChatContextClassRegistry(object):
     def __init__(self):
         self.contexts = dict()
         self._chat_type_reg = dict()
+        self._any_class = None
 
     def register_class(self, class_):
         assert decorators.has_chattype(class_)
-        for chat_type in getattr(class_, '_TELEGRAM_chattype'):
-            print(self._chat_type_reg.get(chat_type))
+        chat_types = getattr(class_, decorators.TAG_CHATTYPE)
+        for chat_type in chat_types:
+            LOG.debug('registering %s for chat_type %s', class_, chat_type)
             assert not self._chat_type_reg.get(chat_type)
             self._chat_type_reg[chat_type] = class_
+        if CHAT_TYPE.ANY in chat_types:
+            self._any_class = class_
 
     def class_for_type(self, chat_type):
-        assert chat_type in CHAT_TYPE
-        return self._chat_type_reg.get(chat_type)
+        """
+            Return the class registered for chat_type, falling back to the
+            one registered for CHAT_TYPE.ANY.
+        """
+        assert chat_type in _CHAT_TYPES
+        return self._chat_type_reg.get(chat_type, self._any_class)
+
+
+def _private_args(username, first_name, last_name):
+    return first_name, last_name, username
+
+def _title_args(title, first_name, last_name):
+    return (title,)
+
+_CONTEXT_CLASSES = {
+    CHAT_TYPE.PRIVATE: (PrivateChatContext, _private_args),
+    CHAT_TYPE.GROUP: (GroupChatContext, _title_args),
+    CHAT_TYPE.SUPERGROUP: (GroupChatContext, _title_args),
+    CHAT_TYPE.CHANNEL: (ChannelChatContext, _title_args),
+}
 
 
 class ChatContextFactory(object):
@@ -282,56 +357,128 @@ class ChatContextFactory(object):
                 first_name,
                 last_name
                 ):
-        result = None
         handler_class = self._clsreg.class_for_type(chat_type)
-        if not handler_class and self._clsreg.class_for_type(CHAT_TYPE.ANY):
-            handler_class = self._clsreg.class_for_type(CHAT_TYPE.ANY)
-        if handler_class:
-            if chat_type == CHAT_TYPE.PRIVATE:
-                result = PrivateChatContext(dispatcher, chat_id, first_name, last_name, username_or_title)
-            elif chat_type == CHAT_TYPE.GROUP:
-                result = GroupChatContext(dispatcher, chat_id, username_or_title)
-            elif chat_type == CHAT_TYPE.SUPERGROUP:
-                result = GroupChatContext(dispatcher, chat_id, username_or_title)
-            elif chat_type == CHAT_TYPE.CHANNEL:
-                result = ChannelChatContext(dispatcher, chat_id, username_or_title)
-            result.register_handler(handler_class(result))
+        if not handler_class:
+            return None
+        context_class, context_args = _CONTEXT_CLASSES[chat_type]
+        result = context_class(dispatcher, chat_id,
+                               *context_args(username_or_title, first_name, last_name))
+        result.register_handler(handler_class(result))
         return result
 
 
 class ChatContextRegistry(object):
 
-    def __init__(self, dispatcher, idle_timeout=1800):
+    def __init__(self, dispatcher, idle_timeout=1800, max_contexts=None):
+        if max_contexts is not None and max_contexts < 1:
+            raise ValueError('max_contexts must be at least 1, got %r'
+                             % (max_contexts,))
         self.contexts = dict()
         self.idle_timeout = idle_timeout
+        self.max_contexts = max_contexts
         self.dispatcher = dispatcher
+        self._by_last_active = []
+        self._lock = threading.Lock()
         self._session = None
         self.post_invocation = None
 
     def __getitem__(self, key):
-        result = self.contexts.get(key)
-        return result
+        return self.contexts.get(key)
+
+    def get(self, key):
+        return self[key]
 
     def __setitem__(self, key, value):
-        self.contexts[key] = value
+        with self._lock:
+            self.contexts[key] = value
+            if value is not None:
+                heapq.heappush(self._by_last_active, (value.last_active, key))
 
     def __delitem__(self, key):
-        del self.contexts[key]
+        with self._lock:
+            self.contexts.pop(key, None)
 
     def idle(self):
-        now, idle_list = datetime.now(), list()
-        for ctx in self.contexts.values():
+        """
+            Pop the contexts whose last known activity is older than
+            idle_timeout. Entries are pushed once per context and refreshed
+            lazily here, so the sweep only visits the oldest contexts.
+            on_idle is called without holding the registry lock.
+        """
+        heap, candidates, idle_list, keep = self._by_last_active, list(), list(), list()
+        heappop, heappush, get_ctx = heapq.heappop, heapq.heappush, self.contexts.get
+        limit = time.monotonic_ns() - self.idle_timeout * NS_PER_SECOND
+        with self._lock:
+            seen = set()
+            while heap and heap[0][0] < limit:
+                last_active, chat_id = heappop(heap)
+                ctx = get_ctx(chat_id)
+                if ctx is None or chat_id in seen:
+                    continue
+                if ctx.last_active > last_active:
+                    heappush(heap, (ctx.last_active, chat_id))
+                    continue
+                seen.add(chat_id)
+                candidates.append(ctx)
+        for ctx in candidates:
             LOG.info('ctx %s is being verified, last_active: %s', ctx.chat_id, ctx.last_active)
-            if (now - ctx.last_active).seconds > self.idle_timeout:
-                active = ctx.on_idle()
-                if not active:
-                    print('ctx %s is going to be unloaded', ctx.chat_id)
-                    idle_list.append(ctx)
+            keep.append((ctx.last_active, ctx.chat_id))
+            active = ctx.on_idle()
+            if not active:
+                LOG.info('ctx %s is going to be unloaded', ctx.chat_id)
+                idle_list.append(ctx)
+        with self._lock:
+            if len(keep) > len(heap):
+                heap.extend(keep)
+                heapq.heapify(heap)
+            else:
+                for entry in keep:
+                    heappush(heap, entry)
         return idle_list
 
+    def overflow(self, keep_id=None):
+        """
+            Remove and return the least recently active contexts in excess of
+            max_contexts, using the same lazily refreshed heap as idle.
+            The context of keep_id, usually the one just added, is never
+            evicted.
+        """
+        if self.max_contexts is None:
+            return EMPTY_TUPLE
+        heap, contexts, result, kept = self._by_last_active, self.contexts, list(), None
+        with self._lock:
+            excess = len(contexts) - self.max_contexts
+            while excess > 0 and heap:
+                entry = heapq.heappop(heap)
+                last_active, chat_id = entry
+                ctx = contexts.get(chat_id)
+                if ctx is None:
+                    continue
+                if ctx.last_active > last_active:
+                    heapq.heappush(heap, (ctx.last_active, chat_id))
+                    continue
+                if chat_id == keep_id:
+                    kept = entry
+                    continue
+                del contexts[chat_id]
+                result.append(ctx)
+                excess -= 1
+            if kept is not None:
+                heapq.heappush(heap, kept)
+        return result
+
+    def next_idle_deadline(self):
+        """
+            Return the earliest time.monotonic_ns() at which a context may
+            turn idle, None when there are no contexts.
+        """
+        heap = self._by_last_active
+        with self._lock:
+            oldest = heap[0][0] if heap else None
+        return None if oldest is None else oldest + self.idle_timeout * NS_PER_SECOND
 
     def all(self):
-        return self.contexts.values()
+        return tuple(self.contexts.values())
 
 
 class ChatContextManager(object):
@@ -342,13 +489,65 @@ class ChatContextManager(object):
         self._ctxregistry.dispatcher = dispatcher
         self._clsregistry = ChatContextClassRegistry()
         self._ctxfactory = ChatContextFactory(self._clsregistry)
+        # Registries keeping the base __getitem__ are read straight from
+        # their dict, the others through their own lookup
+        if type(ctx_registry).__getitem__ is ChatContextRegistry.__getitem__:
+            self.get = ctx_registry.contexts.get
+        else:
+            self.get = ctx_registry.get
+        if HAS_UWSGI:
+            self._create_locks = (LOCK,)
+        else:
+            self._create_locks = tuple(threading.Lock()
+                                       for _ in range(CREATE_LOCK_STRIPES))
 
     def __getitem__(self, key):
-        return self._ctxregistry[key]
+        return self.get(key)
 
     def new_chat_context(self, chat_id, chat_type, username_or_title, first_name, last_name):
+        result, evicted = self._create(chat_id, chat_type, username_or_title, first_name, last_name)
+        self._evicted(evicted)
+        return result
+
+    def _create(self, chat_id, chat_type, username_or_title, first_name, last_name):
+        """
+            Create and store the chat context for chat_id, return it along
+            with the contexts evicted to stay within max_contexts.
+        """
         result = self._ctxfactory.new_chat_context(self._dispatcher, chat_id, chat_type, username_or_title, first_name, last_name)
-        self._ctxregistry[chat_id] = result
+        evicted = EMPTY_TUPLE
+        if result:
+            self._ctxregistry[chat_id] = result
+            evicted = self._ctxregistry.overflow(chat_id)
+        return result, evicted
+
+    def _evicted(self, contexts):
+        """
+            Queue on_idle for contexts evicted by max_contexts on the pool
+            worker of their chat, after the updates already queued for it.
+            Eviction is forced, the value returned by on_idle is ignored.
+        """
+        notify = self._dispatcher.pool.notify
+        for ctx in contexts:
+            LOG.info('ctx %s evicted, max_contexts reached', ctx.chat_id)
+            notify((ctx.on_idle, EMPTY_TUPLE, EMPTY_DICT), ctx.chat_id)
+
+    def get_or_create(self, chat_id, chat_type, username_or_title, first_name, last_name):
+        """
+            Return the chat context for chat_id, creating it if it does not
+            exist yet. Existing contexts are returned unlocked, creation is
+            serialized per lock stripe of chat_id. Evicted contexts are
+            notified after the stripe is released.
+        """
+        result = self.get(chat_id)
+        if not result:
+            evicted, locks = EMPTY_TUPLE, self._create_locks
+            with locks[chat_id % len(locks)]:
+                result = self.get(chat_id)
+                if not result:
+                    result, evicted = self._create(chat_id, chat_type,
+                            username_or_title, first_name, last_name)
+            self._evicted(evicted)
         return result
 
     def register_class(self, cls_):
@@ -361,6 +560,9 @@ class ChatContextManager(object):
     def idle(self):
         return self._ctxregistry.idle()
 
+    def next_idle_deadline(self):
+        return self._ctxregistry.next_idle_deadline()
+
     def all(self):
         return self._ctxregistry.all()
 
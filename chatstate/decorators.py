@@ -1,22 +1,25 @@
 import logging
+import sys
 import types
-
-from chatstate import CHAT_TYPE
-
-TAG_ACTIVATE        = '_TELEGRAM_activate'
-TAG_IDLE            = '_TELEGRAM_deactivate'
-TAG_EVENT           = '_TELEGRAM_event'
-TAG_MESSAGE         = '_TELEGRAM_message'
-TAG_COMMAND         = '_TELEGRAM_command'
-TAG_DOCUMENT        = '_TELEGRAM_document'
-TAG_PHOTO           = '_TELEGRAM_photo'
-TAG_VIDEO           = '_TELEGRAM_video'
-TAG_NEWCHATMEMBER   = '_TELEGRAM_newchatmember'
-TAG_LEFTCHATMEMBER  = '_TELEGRAM_leftchatmember'
-TAG_CALLBACKQUERY   = '_TELEGRAM_callbackquery'
-TAG_CHATTYPE        = '_TELEGRAM_chattype'
-TAG_INLINEQUERY     = '_TELEGRAM_inlinequery'
-TAG_STOP            = '_TELEGRAM_stop'
+import weakref
+
+from chatstate import CHAT_TYPE, CHAT_TYPE_NAME, EMPTY_TUPLE
+
+TAG_ACTIVATE        = sys.intern('_TELEGRAM_activate')
+TAG_IDLE            = sys.intern('_TELEGRAM_deactivate')
+TAG_EVENT           = sys.intern('_TELEGRAM_event')
+TAG_MESSAGE         = sys.intern('_TELEGRAM_message')
+TAG_COMMAND         = sys.intern('_TELEGRAM_command')
+TAG_DOCUMENT        = sys.intern('_TELEGRAM_document')
+TAG_PHOTO           = sys.intern('_TELEGRAM_photo')
+TAG_VIDEO           = sys.intern('_TELEGRAM_video')
+TAG_NEWCHATMEMBER   = sys.intern('_TELEGRAM_newchatmember')
+TAG_LEFTCHATMEMBER  = sys.intern('_TELEGRAM_leftchatmember')
+TAG_CALLBACKQUERY   = sys.intern('_TELEGRAM_callbackquery')
+TAG_CHATTYPE        = sys.intern('_TELEGRAM_chattype')
+TAG_INLINEQUERY     = sys.intern('_TELEGRAM_inlinequery')
+TAG_STOP            = sys.intern('_TELEGRAM_stop')
+TAG_HANDLERTABLE    = sys.intern('_TELEGRAM_handlertable')
 
 LOG = logging.getLogger(__name__)
 
@@ -24,69 +27,65 @@ LOG = logging.getLogger(__name__)
 '''
     Method decorators
 '''
+_NO_TAGS = frozenset()
+
+def _update_tag(f, tag, value):
+    LOG.debug('_update_tag: tag %s, value %s', tag, value)
+    if not isinstance(value, (list, tuple, set, frozenset)):
+        value = (value,)
+    setattr(f, tag, f.__dict__.get(tag, _NO_TAGS).union(value))
+    return f
+
+
 class MethodDecorator:
     def __init__(self, chat_type):
         assert isinstance(chat_type, (int, list, tuple, set))
         self._chat_type = chat_type
 
     def __call__(self, f):
-        return self._update_tag(f, TAG_CHATTYPE, self._chat_type)
-
-    @staticmethod
-    def _update_tag(f, tag, value):
-        assert tag is not None
-        assert isinstance(tag, str)
-
-        LOG.debug('_update_tag: tag {}, value {}'.format(tag, value))
-        curvals = getattr(f, tag) if hasattr(f, tag) else set()
-        if isinstance(value, (list, tuple, set)):
-            curvals.update(value)
-        else:
-            curvals.add(value)
-        setattr(f, tag, curvals)
-        return f
+        return _update_tag(f, TAG_CHATTYPE, self._chat_type)
 
 
 class message(MethodDecorator):
     def __call__(self, f):
         f = super().__call__(f)
-        return self._update_tag(f, TAG_MESSAGE, self._chat_type)
+        return _update_tag(f, TAG_MESSAGE, self._chat_type)
 
 
 class callback_query(MethodDecorator):
     def __call__(self, f):
         f = super().__call__(f)
-        return self._update_tag(f, TAG_CALLBACKQUERY, self._chat_type)
+        return _update_tag(f, TAG_CALLBACKQUERY, self._chat_type)
 
 
 class new_chat_member(MethodDecorator):
     def __call__(self, f):
         f = super().__call__(f)
-        return self._update_tag(f, TAG_NEWCHATMEMBER, self._chat_type)
+        return _update_tag(f, TAG_NEWCHATMEMBER, self._chat_type)
 
 
 class left_chat_member(MethodDecorator):
     def __call__(self, f):
         f = super().__call__(f)
-        return self._update_tag(f, TAG_LEFTCHATMEMBER, self._chat_type)
+        return _update_tag(f, TAG_LEFTCHATMEMBER, self._chat_type)
 
 
 class activate(MethodDecorator):
      def __call__(self, f):
         f = super().__call__(f)
-        return self._update_tag(f, TAG_ACTIVATE, self._chat_type)
+        return _update_tag(f, TAG_ACTIVATE, self._chat_type)
 
 
 class idle(MethodDecorator):
      def __call__(self, f):
         f = super().__call__(f)
-        return self._update_tag(f, TAG_IDLE, self._chat_type)
+        return _update_tag(f, TAG_IDLE, self._chat_type)
 
 
 class stop(MethodDecorator):
      def __call__(self, f):
         f = super().__call__(f)
-        return self._update_tag(f, TAG_STOP, self._chat_type)
+        return _update_tag(f, TAG_STOP, self._chat_type)
 
 
 class command(MethodDecorator):
@@ -97,25 +96,25 @@ class command(MethodDecorator):
 
     def __call__(self, f):
         f = super().__call__(f)
-        return self._update_tag(f, TAG_COMMAND, self._command)
+        return _update_tag(f, TAG_COMMAND, self._command)
 
 
 class document(MethodDecorator):
      def __call__(self, f):
         f = super().__call__(f)
-        return self._update_tag(f, TAG_DOCUMENT, self._chat_type)
+        return _update_tag(f, TAG_DOCUMENT, self._chat_type)
 
 
 class photo(MethodDecorator):
      def __call__(self, f):
         f = super().__call__(f)
-        return self._update_tag(f, TAG_PHOTO, self._chat_type)
+        return _update_tag(f, TAG_PHOTO, self._chat_type)
 
 
 class video(MethodDecorator):
      def __call__(self, f):
         f = super().__call__(f)
-        return self._update_tag(f, TAG_VIDEO, self._chat_type)
+        return _update_tag(f, TAG_VIDEO, self._chat_type)
 
 
 class event(MethodDecorator):
@@ -127,7 +126,7 @@ class event(MethodDecorator):
 
     def __call__(self, f):
         f = super().__call__(f)
-        return self._update_tag(f, TAG_EVENT, self._name)
+        return _update_tag(f, TAG_EVENT, self._name)
 
 
 class inline_query(MethodDecorator):
@@ -139,113 +138,161 @@ class inline_query(MethodDecorator):
 
     def __call__(self, f):
         f = super().__call__(f)
-        return self._update_tag(f, TAG_INLINEQUERY, self._name)
+        return _update_tag(f, TAG_INLINEQUERY, self._name)
 
 
 '''
     Class decorators
 '''
 class chatstate(MethodDecorator):
-    pass
+    def __call__(self, cls):
+        cls = super().__call__(cls)
+        chat_types = cls.__dict__[TAG_CHATTYPE]
+        if CHAT_TYPE.ANY in chat_types:
+            chat_types = CHAT_TYPE_NAME
+        for chat_type in chat_types:
+            layout_for(chat_type, cls)
+        return cls
 
 
 '''
     Inspection functions
 '''
 def has_chattype(cls):
-    return hasattr(cls, TAG_CHATTYPE)
+    return getattr(cls, TAG_CHATTYPE, None) is not None
 
 def has_inlinequery(f):
-    return hasattr(f, TAG_INLINEQUERY)
+    return getattr(f, TAG_INLINEQUERY, None) is not None
 
 def has_activate(f):
-    return hasattr(f, TAG_ACTIVATE)
+    return getattr(f, TAG_ACTIVATE, None) is not None
+
+_TAGGED_NAMES_CACHE = weakref.WeakKeyDictionary()
+
+def _tagged_names(cls):
+    names = _TAGGED_NAMES_CACHE.get(cls)
+    if names is None:
+        seen, tagged = set(), list()
+        for class_ in cls.__mro__:
+            for name, attr in class_.__dict__.items():
+                if name in seen:
+                    continue
+                seen.add(name)
+                if _is_tagged(attr):
+                    tagged.append(name)
+        names = _TAGGED_NAMES_CACHE[cls] = tuple(sorted(tagged))
+    return names
+
+def _tags(attr):
+    """Return the tag dict of a function, classmethod or staticmethod"""
+    return getattr(attr, '__func__', attr).__dict__
+
+def _is_tagged(attr):
+    func = getattr(attr, '__func__', attr)
+    return (isinstance(func, types.FunctionType)
+            and func.__dict__.get(TAG_CHATTYPE) is not None)
 
 def methods(obj):
-    return [method
-                for method in map(lambda x: getattr(obj, x), dir(obj))
-                if isinstance(method, types.MethodType) and hasattr(method, TAG_CHATTYPE)]
+    return [getattr(obj, name) for name in _tagged_names(type(obj))]
 
 def is_suitable(ctype, ctypes):
     return ctype in ctypes or CHAT_TYPE.ANY in ctypes
 
+
+'''
+    Handler extraction
+'''
+class HandlerTable(object):
+    """Handlers of a chatstate instance for a single chat type"""
+
+    __slots__ = ('message', 'command', 'document', 'photo', 'video',
+                 'callback_query', 'event', 'activate', 'new_chat_member',
+                 'left_chat_member', 'idle', 'stop')
+
+    SINGLE = tuple(slot for slot in __slots__ if slot not in ('command', 'event'))
+
+    def __init__(self):
+        for slot in self.SINGLE:
+            setattr(self, slot, None)
+        self.command = dict()
+        self.event = dict()
+
+    def bind(self, instance):
+        """
+            Build the table of bound methods of instance out of a table
+            holding attribute names.
+        """
+        result = HandlerTable()
+        for slot in self.SINGLE:
+            name = getattr(self, slot)
+            if name is not None:
+                setattr(result, slot, getattr(instance, name))
+        result.command = {cmd: getattr(instance, name)
+                          for cmd, name in self.command.items()}
+        result.event = {evt: tuple(getattr(instance, name) for name in names)
+                        for evt, names in self.event.items()}
+        return result
+
+
+def layout_for(chat_type, cls):
+    """
+        Return the HandlerTable of attribute names of cls for chat_type.
+        Layouts are kept on the class itself, the chatstate decorator
+        builds them up front for the chat types it declares.
+    """
+    tables = cls.__dict__.get(TAG_HANDLERTABLE)
+    if tables is None:
+        tables = dict()
+        setattr(cls, TAG_HANDLERTABLE, tables)
+    layout = tables.get(chat_type)
+    if layout is None:
+        layout = tables[chat_type] = _extract_layout(chat_type, cls)
+    return layout
+
 def extract_handlers(chat_type, handler):
-    message_handler = None
-    command_handlers = dict()
-    document_handler = None
-    photo_handler = None
-    video_handler = None
-    callback_query_handler = None
-    newchatmember_handler = None
-    leftchatmember_handler = None
-    event_handlers = dict()
-    activate_handler = idle_handler = stop_handler = None
-    LOG.debug('register handlers for {} instance'.format(handler))
-    for method in methods(handler):
-        mtypes = getattr(method, TAG_CHATTYPE)
+    """Return the HandlerTable of handler's bound methods for chat_type"""
+    return layout_for(chat_type, type(handler)).bind(handler)
+
+_TAG_TO_SLOT = {
+    TAG_MESSAGE: 'message',
+    TAG_COMMAND: 'command',
+    TAG_DOCUMENT: 'document',
+    TAG_PHOTO: 'photo',
+    TAG_VIDEO: 'video',
+    TAG_CALLBACKQUERY: 'callback_query',
+    TAG_EVENT: 'event',
+    TAG_ACTIVATE: 'activate',
+    TAG_NEWCHATMEMBER: 'new_chat_member',
+    TAG_LEFTCHATMEMBER: 'left_chat_member',
+    TAG_IDLE: 'idle',
+    TAG_STOP: 'stop',
+}
+
+def _extract_layout(chat_type, cls):
+    layout = HandlerTable()
+    LOG.debug('register handlers for %s class', cls)
+    for name in _tagged_names(cls):
+        method = getattr(cls, name)
+        tags = _tags(method)
+        mtypes = tags[TAG_CHATTYPE]
         LOG.debug('method %s, chat_types: %s', method, mtypes)
-        if chat_type in mtypes or CHAT_TYPE.ANY in mtypes:
-            if hasattr(method, TAG_MESSAGE):
-                LOG.debug('found message handler ' + str(method))
-                assert message_handler is None
-                message_handler = method
-            if hasattr(method, TAG_COMMAND):
-                for cmd in getattr(method, TAG_COMMAND):
-                    LOG.debug('found command handler ' + str(method))
-                    assert cmd not in command_handlers
-                    command_handlers[cmd] = method
-            if hasattr(method, TAG_DOCUMENT):
-                LOG.debug('found document handler ' + str(method))
-                assert document_handler is None
-                document_handler = method
-            if hasattr(method, TAG_PHOTO):
-                LOG.debug('found photo handler ' + str(method))
-                assert photo_handler is None
-                photo_handler = method
-            if hasattr(method, TAG_VIDEO):
-                LOG.debug('found video handler ' + str(method))
-                assert video_handler is None
-                video_handler = method
-            if hasattr(method, TAG_CALLBACKQUERY):
-                LOG.debug('found callback_query handler ' + str(method))
-                assert callback_query_handler is None
-                callback_query_handler = method
-            if hasattr(method, TAG_EVENT):
-                LOG.debug('found event handler %s', str(method))
-                events = getattr(method, TAG_EVENT)
-                for evt in events:
-                    event_handlers.setdefault(evt, []).append(method)
-            if hasattr(method, TAG_ACTIVATE):
-                LOG.debug('found activate ' + str(method))
-                assert activate_handler is None
-                activate_handler = method
-            if hasattr(method, TAG_NEWCHATMEMBER):
-                LOG.debug('found newchatmember handler ' + str(method))
-                assert newchatmember_handler is None
-                newchatmember_handler = method
-            if hasattr(method, TAG_LEFTCHATMEMBER):
-                LOG.debug('found leftchatmember handler ' + str(method))
-                assert leftchatmember_handler is None
-                leftchatmember_handler = method
-            if hasattr(method, TAG_IDLE):
-                LOG.debug('found idle ' + str(method))
-                assert idle_handler is None
-                idle_handler = method
-            if hasattr(method, TAG_STOP):
-                LOG.debug('found stop handler ' + str(method))
-                assert stop_handler is None
-                stop_handler = method
-
-    return message_handler, \
-            command_handlers, \
-            document_handler, \
-            photo_handler, \
-            video_handler, \
-            callback_query_handler, \
-            event_handlers, \
-            activate_handler, \
-            newchatmember_handler, \
-            leftchatmember_handler, \
-            idle_handler, \
-            stop_handler
-
+        if not is_suitable(chat_type, mtypes):
+            continue
+        for tag, value in tags.items():
+            slot = _TAG_TO_SLOT.get(tag)
+            if slot is None:
+                continue
+            LOG.debug('found %s handler %s', slot, method)
+            if slot == 'command':
+                for cmd in value:
+                    cmd = sys.intern(cmd)
+                    assert cmd not in layout.command
+                    layout.command[cmd] = name
+            elif slot == 'event':
+                for evt in value:
+                    evt = sys.intern(evt)
+                    layout.event[evt] = layout.event.get(evt, EMPTY_TUPLE) + (name,)
+            else:
+                assert getattr(layout, slot) is None
+                setattr(layout, slot, name)
+    return layout
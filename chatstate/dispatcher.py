@@ -3,26 +3,40 @@
 """
 
 import logging
+import sys
+import threading
+import time
 
 from telegram.error import TelegramError
 
-from chatstate import CHAT_TYPE, CHAT_TYPE_NAME, EMPTY_DICT, EMPTY_TUPLE, \
+from chatstate import CHAT_TYPE, CHAT_TYPE_BY_NAME, EMPTY_DICT, EMPTY_TUPLE, \
                         threadpool, decorators
 from chatstate.context import ChatContextManager, ChatContextRegistry
-from chatstate.threadpool import LOCK
 
 LOG = logging.getLogger(__name__)
 
+IDLE_CHECK_UPDATES = 64
+
 
 class BaseUpdateProcessor(object):
     """Base class for update processors"""
 
+    __slots__ = ('_dispatcher', '_manager', '_pool', '_bot', '_me',
+                 '_notify', '_notify_unary', '_get', '_get_or_create')
+
+    # Update attribute that this processor is responsible for
+    FIELD = None
+
     def __init__(self, dispatcher):
         self._dispatcher = dispatcher
         self._manager = dispatcher.manager
         self._pool = dispatcher.pool
         self._bot = dispatcher.bot
         self._me = dispatcher.me
+        self._notify = dispatcher.pool.notify
+        self._notify_unary = dispatcher.pool.notify_unary
+        self._get = dispatcher.manager.get
+        self._get_or_create = dispatcher.manager.get_or_create
 
     @staticmethod
     def responsible_for(update):
@@ -33,10 +47,29 @@ class BaseUpdateProcessor(object):
         """Raise an NotImplementedError"""
         raise NotImplementedError
 
+    def _chat_context_for(self, message):
+        """
+            Return the chat context for message's chat and its chat_type.
+            A new chat context is instatiated if necessary.
+        """
+        chat = message.chat
+        chat_context = self._get(chat.id)
+        if chat_context:
+            return chat_context, chat_context.chat_type
+        chat_type = CHAT_TYPE_BY_NAME[chat.type]
+        uog = chat.username if chat_type == CHAT_TYPE.PRIVATE else chat.title
+        chat_context = self._get_or_create(chat.id, chat_type, uog,
+                                           chat.first_name, chat.last_name)
+        return chat_context, chat_type
+
 
 class MessageProcessor(BaseUpdateProcessor):
     """Update processor that handle messages"""
 
+    __slots__ = ()
+
+    FIELD = 'message'
+
     @staticmethod
     def responsible_for(update):
         """
@@ -51,36 +84,23 @@ class MessageProcessor(BaseUpdateProcessor):
             The message is routed to the destination chat_context.
             A new chat context is instatiated if necessary.
         """
-        chat_id, chat_type, uog, first_name, last_name = _extract_chat_data(\
-                                        update.message)
-        chat_context = self._manager[chat_id]
-        if not chat_context:
-            with LOCK:
-                chat_context = self._manager[chat_id]
-                if not chat_context:
-                    chat_context = self._manager.new_chat_context(chat_id,\
-                                        chat_type, uog, first_name, last_name)
+        chat_context, chat_type = self._chat_context_for(update.message)
         if chat_context:
             exc.ctx = chat_context
-            self._pool.notify(
-                (chat_context.handle_message, (update,), EMPTY_DICT)
-                )
+            self._notify_unary(chat_context.handle_message, update,
+                               chat_context.chat_id)
         else:
             LOG.info('got update.message for unknown chat_type: %s', chat_type)
         return True
 
 
-def _extract_chat_data(message):
-    """Extract chat identifiers for a message"""
-    chat = message.chat
-    chat_id, chat_type = chat.id, getattr(CHAT_TYPE_NAME, chat.type)
-    user_or_group = chat.username if chat_type == CHAT_TYPE.PRIVATE else chat.title
-    return chat_id, chat_type, user_or_group, chat.first_name, chat.last_name
-
-
 class CallbackQueryProcessor(BaseUpdateProcessor):
     """Update processor that processes callback queries"""
 
+    __slots__ = ()
+
+    FIELD = 'callback_query'
+
     @staticmethod
     def responsible_for(update):
         """Check wheter this processor is responsible for update"""
@@ -92,19 +112,15 @@ class CallbackQueryProcessor(BaseUpdateProcessor):
             callback_query handlers are invocated on destination chat_context.
             A new chat_context is instatiated if necessary.
         """
-        message = update.callback_query.message
-        chat_id, chat_type, uog, first_name, last_name = _extract_chat_data(message)
-        chat_context = self._manager[chat_id]
-        if not chat_context:
-            with LOCK:
-                chat_context = self._manager[chat_id]
-                if not chat_context:
-                    chat_context = self._manager.new_chat_context(chat_id,\
-                                        chat_type, uog, first_name, last_name)
+        chat_context, chat_type = self._chat_context_for(\
+                                        update.callback_query.message)
         if chat_context:
             exc.ctx = chat_context
-            self._pool.notify(
-                (chat_context.handle_callback_query, (update,), EMPTY_DICT))
+            if chat_context.handles_callback_query():
+                self._notify_unary(chat_context.handle_callback_query,
+                                   update, chat_context.chat_id)
+            else:
+                chat_context.handle_callback_query(update)
         else:
             LOG.info('callback_query for unknow chat_type: %s', chat_type)
         return False
@@ -113,6 +129,10 @@ class CallbackQueryProcessor(BaseUpdateProcessor):
 class InlineQueryProcessor(BaseUpdateProcessor):
     """Update processor the processes inline queries"""
 
+    __slots__ = ()
+
+    FIELD = 'inline_query'
+
     @staticmethod
     def responsible_for(update):
         """Check wheter this processor is responsible for update"""
@@ -120,47 +140,76 @@ class InlineQueryProcessor(BaseUpdateProcessor):
 
     def process(self, exc, update):
         """Check wheter this processor is responsible for update"""
-        inline_query, handler = update.inline_query, None
-        lquery, handler = inline_query.query.lower(), None
-        for key in getattr(self._dispatcher, '_inlinequery_reg'):
-            if key.startswith(lquery.lower()):
-                handler = getattr(self._dispatcher, '_inlinequery_reg')[key]
-                break
+        lquery = update.inline_query.query.casefold()
+        handler = self._dispatcher._inlinequery_prefixes.get(lquery)
         if handler:
-            self._pool.notify(
-                (handler, (self._dispatcher.bot, update), EMPTY_DICT))
+            self._notify((handler, (self._bot, update), EMPTY_DICT))
         return False
 
 
 class ProcessorChain(object):
-    """Chain of responsability for update processors"""
+    """
+        Chain of responsability for update processors.
+        Processors declaring the update FIELD they handle are matched on it
+        directly, the others through their responsible_for.
+    """
+
+    __slots__ = ('_processors', '_steps')
 
     def __init__(self, processors):
         self._processors = processors
+        self._steps = tuple((proc.FIELD, proc.responsible_for, proc.process)
+                            for proc in processors)
 
     def process(self, exc, update):
         """Route an update trough the processor chain"""
-        assert exc
-        assert update
-        for proc in self._processors:
-            continue_ = True
-            if proc.responsible_for(update):
-                continue_ = proc.process(exc, update)
-            if not continue_:
+        for field, responsible_for, process in self._steps:
+            if field is not None:
+                if getattr(update, field, None) is None:
+                    continue
+            elif not responsible_for(update):
+                continue
+            if not process(exc, update):
                 break
 
 
 class BaseChatContextManager(object):
     """Basic 'Do nothing' context manager for update processing"""
 
+    __slots__ = ('ctx',)
+
     def __init__(self):
         self.ctx = None
 
     def __enter__(self):
-        pass
+        return self
 
     def __exit__(self, type_, value, traceback):
-        pass
+        return False
+
+
+def _call_each(methods, args):
+    """
+        Call every method in methods with args. A failing method is logged
+        and does not keep the others from being called.
+    """
+    for method in methods:
+        try:
+            method(*args)
+        except Exception:
+            LOG.exception('%r failed', method)
+
+
+def _is_null_execution(execution):
+    """
+        Check whether execution, a class or an instance, keeps the no-op
+        __enter__ and __exit__ of BaseChatContextManager, so the dispatcher
+        can reuse one per thread and skip the with block.
+    """
+    cls = execution if isinstance(execution, type) else type(execution)
+    return issubclass(cls, BaseChatContextManager) \
+            and cls.__enter__ is BaseChatContextManager.__enter__ \
+            and cls.__exit__ is BaseChatContextManager.__exit__
 
 
 class ChatContextDispatcher(object):
@@ -175,7 +224,8 @@ class ChatContextDispatcher(object):
                  dispatch_execution_kwargs=EMPTY_DICT,
                  context_registry=ChatContextRegistry,
                  context_registry_kwargs=EMPTY_DICT,
-                 single_thread=False):
+                 single_thread=False,
+                 idle_check_interval=None):
         self.bot = bot
         self.me = None
         self.pool = threadpool.make_pool(single_thread)
@@ -185,9 +235,23 @@ class ChatContextDispatcher(object):
                                               **context_registry_kwargs
                                               )
                                          )
+        if not isinstance(dispatch_execution, type) \
+                and not _is_null_execution(dispatch_execution):
+            raise TypeError('dispatch_execution instances are shared among '
+                            'updates, pass the class of %s instead'
+                            % type(dispatch_execution).__name__)
         self._dispatch_execution = dispatch_execution
         self._dispatch_execution_kwargs = dispatch_execution_kwargs
+        self._null_execution = _is_null_execution(dispatch_execution)
+        self._execute = self._execute_null if self._null_execution \
+                            else self._execute_with
+        self._local = threading.local()
         self._inlinequery_reg = dict()
+        self._inlinequery_prefixes = dict()
+        self._idle_lock = threading.Lock()
+        self._idle_check_interval = idle_check_interval
+        self._idle_check_countdown = IDLE_CHECK_UPDATES
+        self._last_idle_check = time.monotonic()
         self._processor_chain = ProcessorChain([
             MessageProcessor(self),
             CallbackQueryProcessor(self),
@@ -196,30 +260,99 @@ class ChatContextDispatcher(object):
     def register_inlinequery_handler(self, function_):
         """Register a function as a query handler"""
         assert decorators.has_inlinequery(function_)
-        for query in getattr(function_, '_TELEGRAM_inlinequery'):
+        for query in getattr(function_, decorators.TAG_INLINEQUERY):
             self._inlinequery_reg[query] = function_
+        prefixes = dict()
+        for query, handler in self._inlinequery_reg.items():
+            query = query.casefold()
+            for end in range(len(query) + 1):
+                prefixes.setdefault(query[:end], handler)
+        self._inlinequery_prefixes = prefixes
 
     def dispatch_update(self, update):
         """Dispatch an update trough the processor_chain"""
         LOG.debug('begin dispatch_update')
         assert update is not None
-        with self._dispatch_execution(**self._dispatch_execution_kwargs) as exc:
+        self._execute(update)
+        if self._idle_check_interval is not None:
+            self._piggyback_idle_check()
+
+    def _execute_null(self, update):
+        """Dispatch update within the calling thread's no-op execution"""
+        self._dispatch(self._thread_execution(), update)
+
+    def _execute_with(self, update):
+        """Dispatch update within a dispatch_execution context manager"""
+        with self._new_execution() as exc:
+            self._dispatch(exc, update)
+
+    def _thread_execution(self):
+        """Return the no-op execution context owned by the calling thread"""
+        exc = getattr(self._local, 'execution', None)
+        if exc is None:
+            exc = self._local.execution = self._new_execution()
+        exc.ctx = None
+        return exc
+
+    def _new_execution(self):
+        """
+            Return the execution context for an update: dispatch_execution
+            itself when a no-op instance was given, else a new instance of it.
+        """
+        execution = self._dispatch_execution
+        if isinstance(execution, type):
+            execution = execution(**self._dispatch_execution_kwargs)
+        return execution
+
+    def _dispatch(self, exc, update):
+        """
+            Route the first update, fetching the bot user if start() did
+            not, then switch to _route so later updates skip the check.
+        """
+        if not self.me:
             try:
-                if not self.me:
-                    self.me = self.bot.getMe()
-                LOG.debug(update)
-                self._processor_chain.process(exc, update)
+                self.me = self.bot.getMe()
             except TelegramError as ex:
                 LOG.error('Error while dispatch_update')
                 LOG.exception(ex)
+                return
+        self._dispatch = self._route
+        self._route(exc, update)
+
+    def _route(self, exc, update):
+        """Route update trough the processor chain within exc"""
+        try:
+            LOG.debug(update)
+            self._processor_chain.process(exc, update)
+        except TelegramError as ex:
+            LOG.error('Error while dispatch_update')
+            LOG.exception(ex)
+
+    def _piggyback_idle_check(self):
+        """
+            Run idle_check every IDLE_CHECK_UPDATES updates, provided that
+            idle_check_interval seconds have passed since the last one and
+            that some context may have reached its idle deadline.
+        """
+        self._idle_check_countdown -= 1
+        if self._idle_check_countdown > 0:
+            return
+        self._idle_check_countdown = IDLE_CHECK_UPDATES
+        now = time.monotonic()
+        if now - self._last_idle_check < self._idle_check_interval \
+                or self._idle_lock.locked():
+            return
+        self._last_idle_check = now
+        deadline = self.manager.next_idle_deadline()
+        if deadline is not None and deadline <= time.monotonic_ns():
+            self.idle_check()
 
     def idle_check(self):
         """Look for idle chatcontexts and optionally remove the from memory"""
         result = []
         LOG.info('Idle check...')
-        to_deactivate = self.manager.idle()
-        with LOCK:
-            for ctx in to_deactivate:
+        with self._idle_lock:
+            for ctx in self.manager.idle():
                 LOG.info('removing idle chatstate %s', ctx.chat_id)
                 self.manager.remove_chat_context(ctx)
                 result.append(ctx)
@@ -227,21 +360,46 @@ class ChatContextDispatcher(object):
 
     def broadcast_event(self, event, data):
         """Broadcast an event and related data to all chat contexts"""
-        for ctx in self.manager.all():
-            self.pool.notify((ctx.on_event, (event, data), EMPTY_DICT))
+        if type(event) is str:
+            event = sys.intern(event)
+        self._notify_batched([(ctx.chat_id, ctx.on_event)
+                              for ctx in self.manager.all()
+                              if ctx.handles_event(event)], (event, data))
+
+    def _notify_batched(self, targets, args):
+        """
+            Queue a call with args of every (chat_id, method) in targets,
+            as one task per pool worker. Methods are grouped by the shard of
+            their chat_id, so they run on the worker handling that chat's
+            updates and never concurrently with them.
+        """
+        workers, groups = self.pool.worker_count, dict()
+        for chat_id, method in targets:
+            groups.setdefault(chat_id % workers, []).append(method)
+        notify = self.pool.notify
+        for shard, methods in groups.items():
+            notify((_call_each, (methods, args), EMPTY_DICT), shard)
 
     def remove_chat_context(self, ctx):
         """Remove a chat context"""
         self.manager.remove_chat_context(ctx)
 
     def start(self):
-        """Start dispatcher activity"""
+        """
+            Start dispatcher activity.
+            The bot user is fetched here, call start() before dispatching
+            updates to keep getMe() off the dispatch path.
+        """
+        if not self.me:
+            self.me = self.bot.getMe()
+        self._dispatch = self._route
         self.pool.start()
         LOG.debug('dispatcher started')
 
     def stop(self):
         """Stop dispatcher activity"""
-        for ctx in self.manager.all():
-            self.pool.notify((ctx.on_stop, EMPTY_TUPLE, EMPTY_DICT))
+        self._notify_batched([(ctx.chat_id, ctx.on_stop)
+                              for ctx in self.manager.all()
+                              if ctx.handles_stop()], EMPTY_TUPLE)
         self.pool.stop()
         LOG.debug('dispatcher stopped')
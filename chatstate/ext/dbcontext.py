@@ -120,6 +120,12 @@ class SqlChatContextRegistry(ChatContextRegistry):
     def idle(self) -> tuple:
         return tuple()
 
+    def overflow(self, keep_id=None) -> tuple:
+        return tuple()
+
+    def next_idle_deadline(self):
+        return None
+
     def all(self):
         session = self._session_factory()
         for dbctx in session.query(SqlContext).filter_by(bot_name=self._bot_name).all():
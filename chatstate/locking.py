@@ -7,6 +7,8 @@ HAS_UWSGI = False
 
 class _generic_Lock(object):
 
+    __slots__ = ()
+
     def __enter__(self):
         self.acquire()
         return self
@@ -17,8 +19,10 @@ class _generic_Lock(object):
 
 class _threading_Lock(_generic_Lock):
 
+    __slots__ = ('_lock',)
+
     def __init__(self):
-        self._lock = threading.RLock()
+        self._lock = threading.Lock()
 
 
     def acquire(self):
@@ -30,6 +34,8 @@ class _threading_Lock(_generic_Lock):
 
 class _uwsgi_Lock(_generic_Lock):
 
+    __slots__ = ()
+
     def acquire(self):
         uwsgi.lock()
         LOG.info('acquired uwsgi lock')
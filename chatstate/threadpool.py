@@ -1,82 +1,55 @@
+import itertools
 import logging
 import threading
-from queue import Queue, Empty
+from collections import deque
 
 from typing import Union
 
-LOG = logging.getLogger(__name__)
-HAS_UWSGI = False
-
-
-try:
-    import uwsgi
-    HAS_UWSGI = True
-    LOG.debug('uWSGI support enabled')
-except:
-    LOG.debug('uWSGI support disabled')
-
-
-class _generic_Lock(object):
-
-    def __enter__(self):
-        self.acquire()
-        return self
-
-    def __exit__(self, exc, type_, tb):
-        self.release()
-
-
-class _threading_Lock(_generic_Lock):
-
-    def __init__(self) -> None:
-        self._lock = threading.RLock()
-
-    def acquire(self) -> None:
-        self._lock.acquire()
-
-    def release(self) -> None:
-        self._lock.release()
-
-
-class _uwsgi_Lock(_generic_Lock):
-
-    def acquire(self) -> None:
-        uwsgi.lock()
-        LOG.info('acquired uwsgi lock')
-
-    def release(self) -> None:
-        uwsgi.unlock()
-        LOG.info('released uwsgi lock')
+from chatstate.locking import HAS_UWSGI, LOCK
 
+LOG = logging.getLogger(__name__)
 
-LOCK: Union[_generic_Lock, None] = None
-if HAS_UWSGI:
-    LOCK = _uwsgi_Lock()
-else:
-    LOCK = _threading_Lock()
+_NO_KWARGS: dict = dict()
 
 
 class ThreadPool(object):
+    """
+        Pool of worker threads, each one draining its own queue.
+        Messages notified with the same shard key, e.g. a chat_id, always
+        land on the same worker and run in order, the others are spread
+        round-robin.
+    """
 
     LOG = logging.getLogger('ThreadPool')
 
     def __init__(self, thread_num: int=4) -> None:
-        self._queue: Queue = Queue()
+        self._queues: list = [deque() for x in range(thread_num)]
+        self._conds: list = [threading.Condition(threading.Lock())
+                             for x in range(thread_num)]
+        self._next = itertools.count()
         self._threads: list = []
         self.running = False
         for x in range(thread_num):
-            t = threading.Thread(target=self.run_thread)
+            t = threading.Thread(target=self.run_thread, args=(x,))
             self.LOG.debug('worker %s created', t.name)
             self._threads.append(t)
 
-    def run_thread(self) -> None:
-        while self.running:
-            try:
-                item = self._queue.get(timeout=5)
-                method, args, kwargs = item
-                method(*args, **kwargs)
-            except Empty:
-                pass
+    def run_thread(self, index: int) -> None:
+        queue, cond = self._queues[index], self._conds[index]
+        while True:
+            with cond:
+                while self.running and not queue:
+                    cond.wait()
+                if not queue:
+                    break
+                batch = tuple(queue)
+                queue.clear()
+            for method, args, kwargs in batch:
+                try:
+                    method(*args, **kwargs)
+                except Exception:
+                    self.LOG.exception('worker %s: task %r failed',
+                                       index, method)
 
     def start(self) -> None:
         self.running = True
@@ -86,14 +59,38 @@ class ThreadPool(object):
 
     def stop(self) -> None:
         self.running = False
+        for cond in self._conds:
+            with cond:
+                cond.notify_all()
         for t in self._threads:
-            while t.isAlive():
-                t.join()
+            if t.ident is None:
+                continue
+            t.join()
             self.LOG.debug('worker %s joined', t.name)
         self.LOG.debug('all threads joined')
 
-    def notify(self, message: object) -> None:
-        self._queue.put(message)
+    @property
+    def worker_count(self) -> int:
+        return len(self._threads)
+
+    def _worker_for(self, shard) -> int:
+        if shard is None:
+            shard = next(self._next)
+        return shard % len(self._queues)
+
+    def notify(self, message: object, shard=None) -> None:
+        index = self._worker_for(shard)
+        cond = self._conds[index]
+        with cond:
+            self._queues[index].append(message)
+            cond.notify()
+
+    def notify_unary(self, method, arg, shard=None) -> None:
+        index = self._worker_for(shard)
+        cond = self._conds[index]
+        with cond:
+            self._queues[index].append((method, (arg,), _NO_KWARGS))
+            cond.notify()
 
 
 class NullThreadPool(object):
@@ -104,10 +101,17 @@ class NullThreadPool(object):
     def stop(self) -> None:
         pass
 
-    def notify(self, message: tuple) -> None:
+    @property
+    def worker_count(self) -> int:
+        return 1
+
+    def notify(self, message: tuple, shard=None) -> None:
         method, args, kwargs = message
         method(*args, **kwargs)
 
+    def notify_unary(self, method, arg, shard=None) -> None:
+        method(arg)
+
 
 def make_pool(single=False) -> Union[NullThreadPool, ThreadPool, None]:
     result: Union[NullThreadPool, ThreadPool, None] = None